@@ -1,11 +1,66 @@
 import asyncio
+import base64
+import math
+import os
 import uuid
-import random
+from array import array
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from azure.iot.hub import IoTHubRegistryManager
+from azure.iot.hub.models import (AuthenticationMechanism, ExportImportDevice,
+                                  QuerySpecification, SymmetricKey)
 from azure.iot.device.aio import IoTHubDeviceClient
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import logging.handlers
 import json
+import queue
+import time
+
+try:
+    import orjson
+
+    def encode_json_line(obj) -> bytes:
+        """Encodes an object as a single newline-terminated line of JSON"""
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+except ImportError:
+    def encode_json_line(obj) -> bytes:
+        """Encodes an object as a single newline-terminated line of JSON"""
+        return (json.dumps(obj, separators=(",", ":")) + "\n").encode()
+
+
+class ChunkedMemoryHandler(logging.handlers.MemoryHandler):
+    """
+    A MemoryHandler which writes its buffered records to the target file handler's
+    stream in a single write, instead of handing them to the target one at a time
+    (which writes and flushes the file once per record).
+    """
+
+    def flush(self):
+        with self.lock:
+            if self.target is None or self.target.stream is None:
+                super().flush()
+                return
+            if not self.buffer:
+                return
+            # Errors are reported like StreamHandler.emit does, so a failed write
+            # doesn't kill the queue listener's thread
+            try:
+                text = "".join(self.target.format(record) + self.target.terminator
+                               for record in self.buffer)
+                with self.target.lock:
+                    self.target.stream.write(text)
+                    self.target.stream.flush()
+            except RecursionError:
+                raise
+            except Exception:
+                self.target.handleError(self.buffer[-1])
+            finally:
+                self.buffer.clear()
+
 
 current_date_time = datetime.now().strftime("%Y_%m_%d_%I_%M_%S_%p")
 log_filename = f"iothub_log_{current_date_time}.log"
@@ -14,30 +69,95 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
 logger = logging.getLogger(__name__)
 file_handler = logging.FileHandler(log_filename, mode="w", encoding="utf-8")
-logger.addHandler(file_handler)
+# Records are buffered and written to the file in chunks of up to 1024, flushing
+# early for errors; records still buffered are lost if the process is killed
+memory_handler = ChunkedMemoryHandler(
+    capacity=1024, flushLevel=logging.ERROR, target=file_handler)
+# Records are handed to a background thread which does the file and console
+# writes, so this module's logging doesn't block the event loop on I/O. The console
+# handler installed by basicConfig is served from the queue too, instead of through
+# propagation to the root logger.
+log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+log_listener = logging.handlers.QueueListener(
+    log_queue, memory_handler, *logging.getLogger().handlers,
+    respect_handler_level=True)
+log_listener.start()
 
 
 class GenerateMacID:
+    # Xen OUI; the first byte after it is limited to 0x00-0x7f
+    MAC_PREFIX = bytes([0x00, 0x16, 0x3e])
+    MAC_PREFIX_TEXT = MAC_PREFIX.hex('-')
+    # Keeps the low 23 bits of a random number as the MAC suffix
+    SUFFIX_MASK = 0x7fffff
+    SUFFIX_SPACE = SUFFIX_MASK + 1
+    # Two-digit hex text of every byte value
+    HEX_BYTES = tuple(f'{i:02x}' for i in range(256))
+
     def __init__(self, num_of_ids):
         self.num_of_ids = num_of_ids
 
+    @classmethod
+    def format_mac(cls, suffix):
+        """Formats a MAC address from its 24-bit suffix"""
+        hex_bytes = cls.HEX_BYTES
+        return '-'.join((cls.MAC_PREFIX_TEXT, hex_bytes[suffix >> 16],
+                         hex_bytes[(suffix >> 8) & 0xff], hex_bytes[suffix & 0xff]))
+
     @staticmethod
     def generate_mac():
         """Generates a random MAC address"""
-        mac = [0x00, 0x16, 0x3e,
-               random.randint(0x00, 0x7f),
-               random.randint(0x00, 0xff),
-               random.randint(0x00, 0xff)]
-        return '-'.join(map(lambda x: f'{x:02x}', mac))
+        return GenerateMacID.format_mac(
+            int.from_bytes(os.urandom(3), 'big') & GenerateMacID.SUFFIX_MASK)
+
+    @classmethod
+    def generate_suffixes(cls, count):
+        """Generates a batch of random MAC suffixes from a single random buffer"""
+        numbers = array('I')
+        numbers.frombytes(os.urandom(numbers.itemsize * count))
+        return map(cls.SUFFIX_MASK.__and__, numbers)
 
     def generate_mac_addresses(self):
         """Generates a list of random MAC addresses"""
-        mac_addresses = set()
+        num_of_ids = max(0, self.num_of_ids)
+        # Collecting n distinct suffixes out of N = 2^23 takes about -N ln(1 - n/N)
+        # draws (roughly n + n^2 / 2^24 for small n); oversampling by the expected
+        # duplicates plus four standard deviations means one batch almost always
+        # covers them
+        expected_duplicates = 0
+        if num_of_ids < self.SUFFIX_SPACE:
+            expected_duplicates = math.ceil(
+                -self.SUFFIX_SPACE * math.log1p(-num_of_ids / self.SUFFIX_SPACE)
+            ) - num_of_ids
+        # A dict deduplicates while keeping draw order, so taking the first n keys
+        # is an unbiased sample (a set would iterate in hash order instead)
+        suffixes = dict.fromkeys(self.generate_suffixes(
+            num_of_ids + expected_duplicates
+            + 4 * math.isqrt(expected_duplicates) + 8))
+
+        while len(suffixes) < num_of_ids:
+            suffixes.update(dict.fromkeys(self.generate_suffixes(
+                num_of_ids - len(suffixes) + 16)))
+
+        # Only the surviving suffixes are turned into strings
+        return list(map(self.format_mac, islice(suffixes, num_of_ids)))
+
+
+class RegistryRetry(Retry):
+    """
+    A urllib3 Retry which also retries POST requests, but only on responses meaning
+    the request was not processed. Bulk creates are not idempotent, so retrying them
+    after a gateway or server error could repeat a request the hub already applied.
+    """
 
-        while len(mac_addresses) < self.num_of_ids:
-            mac_addresses.add(self.generate_mac())
+    UNPROCESSED_STATUSES = frozenset([429, 503])
 
-        return list(mac_addresses)
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST":
+            return status_code in self.UNPROCESSED_STATUSES
+        return super().is_retry(method, status_code, has_retry_after)
 
 
 class DeviceHandler:
@@ -45,24 +165,59 @@ class DeviceHandler:
     A handler for interacting with IoT Hub twins in Azure Cloud.
     """
 
+    # Maximum number of devices accepted by a single bulk registry request
+    BULK_BATCH_SIZE = 100
+    # Device credentials are written one JSON object per line as devices are created
+    CREDENTIALS_FILE_PATH = "iothub_device_credential.ndjson"
+    # Credentials of every device registered by this script, kept across runs
+    KNOWN_DEVICES_FILE_PATH = "known_devices.ndjson"
+    # Lifetime of the SAS tokens signed by the registry client, and how long
+    # before expiry a cached token is replaced
+    SAS_TOKEN_TTL = 3600
+    SAS_TOKEN_REFRESH_MARGIN = 300
+
     def __init__(self, hostname: str, shared_access_key_name: str,
-                 shared_access_key: str):
+                 shared_access_key: str, max_workers: int = 50,
+                 max_concurrent_requests: int = 50,
+                 max_concurrent_connections: int = 50):
         """
         Initializes the DeviceHandler with provided Azure IoT Hub credentials.
 
         :param hostname: The hostname of the IoT Hub.
         :param shared_access_key_name: The shared access key name.
         :param shared_access_key: The shared access key.
+        :param max_workers: Number of threads running blocking registry calls concurrently.
+        :param max_concurrent_requests: Maximum number of registry requests in flight at once.
+        :param max_concurrent_connections: Maximum number of devices connecting at once.
         """
         self.hostname = hostname
         self.shared_access_key_name = shared_access_key_name
         self.shared_access_key = shared_access_key
+        # Device connection strings only differ in device ID and key
+        self._device_connection_template = (
+            f"HostName={hostname};DeviceId=%s;SharedAccessKey=%s")
+        self.max_workers = max_workers
+        self.max_concurrent_requests = max_concurrent_requests
+        self.max_concurrent_connections = max_concurrent_connections
         self.device_client = None
+        self._registry_semaphore = None
+        self._registry_sessions = set()
+        self._known_ids = set()
+        self._known_credentials = {}
+        self._known_devices_file = None
+        self._credentials_file = None
 
     async def connect_hub(self) -> None:
         """
         Connects to the IoT Hub Registry using the provided credentials.
         """
+        # Registry calls are blocking HTTP requests and run in this pool; its size
+        # caps the number of in-flight registry requests
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self.max_workers))
+        # IoT Hub throttles registry operations, so only a bounded number are
+        # issued at once rather than one per device
+        self._registry_semaphore = asyncio.Semaphore(self.max_concurrent_requests)
         try:
             device_connection_string = (
                 f"HostName={self.hostname};"
@@ -71,56 +226,348 @@ class DeviceHandler:
             )
             self.device_client = IoTHubRegistryManager.from_connection_string(
                 device_connection_string)
+            self._configure_transport()
+            self._cache_sas_token()
             logger.info(
                 "Connection established for IoTHub Registry.")
         except Exception as e:
             logger.error(
-                f"Failed to connect with IoTHub Registry: {e}")
+                "Failed to connect with IoTHub Registry: %s", e)
+
+    def _configure_transport(self) -> None:
+        """
+        Keeps the registry client's HTTP sessions open between calls, so registry
+        calls reuse sockets instead of opening a new TLS connection per request.
+        The client keeps one session per thread, so each worker thread of the
+        executor holds its own keep-alive connection.
+        """
+        protocol = self.device_client.protocol
+        protocol.config.session_configuration_callback = self._configure_session
+        protocol.__enter__()
+
+    def _configure_session(self, session, global_config, local_config,
+                           **kwargs) -> dict:
+        """
+        Mounts a pooled, retrying HTTP adapter on the registry client's session.
+        Timed out (408), throttled (429) and server error (5xx) responses are retried
+        with backoff for idempotent methods. The POST used by bulk creates and queries
+        is only retried when throttled (429) or unavailable (503).
+        """
+        if session not in self._registry_sessions:
+            # A session belongs to a single worker thread and only ever has one
+            # request in flight, so one pooled connection to the hub is enough
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=1,
+                pool_block=False,
+                max_retries=RegistryRetry(
+                    total=3, backoff_factor=0.5,
+                    status_forcelist=[408, 429, 500, 502, 503, 504],
+                    raise_on_status=False)
+            )
+            session.mount("https://", adapter)
+            self._registry_sessions.add(session)
+        return kwargs
+
+    def _cache_sas_token(self) -> None:
+        """
+        Makes the registry client reuse its signed SAS token until shortly before it
+        expires, instead of signing a new token for every request. The credentials
+        object wrapped here is the one the client's HTTP pipeline signs requests with.
+        If it can't be wrapped, requests keep being signed individually.
+        """
+        try:
+            auth = self.device_client.protocol.config.credentials
+            sign_session = auth.signed_session
+        except AttributeError as e:
+            logger.warning("SAS token caching is disabled: %s", e)
+            return
+        sas_token = None
+        refresh_at = 0.0
+
+        def signed_session(session=None):
+            nonlocal sas_token, refresh_at
+            if sas_token is None or time.monotonic() >= refresh_at:
+                session = sign_session(session)
+                sas_token = session.headers["Authorization"]
+                refresh_at = (time.monotonic() + self.SAS_TOKEN_TTL
+                              - self.SAS_TOKEN_REFRESH_MARGIN)
+                return session
+            session = session or requests.Session()
+            session.headers["Authorization"] = sas_token
+            return session
+
+        auth.signed_session = signed_session
+
+    async def disconnect_hub(self) -> None:
+        """
+        Closes the HTTP sessions held open by the IoT Hub Registry client in each
+        worker thread.
+        """
+        if self.device_client is None:
+            return
+        try:
+            self.device_client.protocol.__exit__(None, None, None)
+            # Exiting only closes the calling thread's session; the worker
+            # threads' sessions are closed here
+            while self._registry_sessions:
+                self._registry_sessions.pop().close()
+        except Exception as e:
+            logger.error(
+                "Failed to close IoTHub Registry sessions: %s", e)
+
+    async def _call_registry(self, func, *args, **kwargs):
+        """
+        Runs a blocking registry call in the thread pool, limited to
+        max_concurrent_requests calls in flight.
+        """
+        async with self._registry_semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def _load_known_devices(self) -> None:
+        """
+        Loads the credentials of devices registered by earlier runs from the on-disk
+        cache, and opens the cache to append devices registered by this run.
+        """
+        self._known_credentials = {}
+        ends_with_newline = True
+        try:
+            with open(self.KNOWN_DEVICES_FILE_PATH, "rb") as f:
+                for line in f:
+                    ends_with_newline = line.endswith(b"\n")
+                    # A crash during an append can leave a truncated last line;
+                    # bad lines are skipped rather than dropping the rest of the cache
+                    try:
+                        credentials = json.loads(line)
+                        if credentials["hostname"] == self.hostname:
+                            self._known_credentials[credentials["device_id"]] = credentials
+                    except (ValueError, KeyError, TypeError) as e:
+                        logger.error("Skipping invalid known devices cache entry: %s", e)
+            logger.info("Loaded %s known devices from %s",
+                        len(self._known_credentials), self.KNOWN_DEVICES_FILE_PATH)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error("Failed to load known devices cache: %s", e)
+
+        try:
+            self._known_devices_file = open(
+                self.KNOWN_DEVICES_FILE_PATH, "ab", buffering=1 << 16)
+            # Terminate a truncated last line so the next record starts on its own line
+            if not ends_with_newline:
+                self._known_devices_file.write(b"\n")
+        except Exception as e:
+            logger.error("Failed to open known devices cache: %s", e)
+
+    def remember_device_credentials(self, credentials: dict) -> None:
+        """
+        Adds a device's credentials to the known devices cache.
+
+        :param credentials: A dictionary containing the device's credentials.
+        """
+        if self._known_credentials.get(credentials["device_id"]) == credentials:
+            return
+        self._known_credentials[credentials["device_id"]] = credentials
+        if self._known_devices_file is None:
+            return
+        try:
+            self._known_devices_file.write(encode_json_line(credentials))
+        except Exception as e:
+            logger.error(
+                "Failed to cache credentials for device '%s': %s", credentials['device_id'], e)
+
+    async def _close_known_devices_file(self) -> None:
+        """
+        Flushes and closes the known devices cache.
+        """
+        if self._known_devices_file is None:
+            return
+        try:
+            self._known_devices_file.close()
+        except Exception as e:
+            logger.error("Failed to close known devices cache: %s", e)
+        finally:
+            self._known_devices_file = None
 
-    async def create_device(self, device_id: str) -> dict:
+    async def _preload_existing_devices(self) -> None:
+        """
+        Fetches the IDs of all devices already registered in the IoT Hub with a
+        single paged registry query, so existence checks don't need a request per device.
+        """
+        self._known_ids = set()
+        query_specification = QuerySpecification(
+            query="SELECT deviceId FROM devices")
+        continuation_token = None
+        try:
+            while True:
+                query_result = await self._call_registry(
+                    self.device_client.query_iot_hub,
+                    query_specification, continuation_token)
+                self._known_ids.update(
+                    twin.device_id for twin in query_result.items)
+                continuation_token = query_result.continuation_token
+                if not continuation_token:
+                    break
+            logger.info(
+                "Found %s existing devices in IoTHub.", len(self._known_ids))
+        except Exception as e:
+            logger.error("Failed to query existing devices: %s", e)
+
+    async def create_device(self, device_id: str) -> tuple[str, dict]:
         """
         Creates a device in the IoT Hub if it doesn't already exist and returns its credentials.
+        Devices found by the preloaded registry query are looked up directly; any other
+        device is created, falling back to a lookup if the hub reports it already exists.
 
         :param device_id: The ID of the device to create.
-        :return: A dictionary with the device's credentials including hostname and shared access key.
+        :return: The device ID and a dictionary with the device's credentials including
+            hostname and shared access key (empty on failure).
         """
-        try:
-            # Check if the device already exists
-            device = self.device_client.get_device(device_id)
-            logger.info(f"Device '{device_id}' already exists.")
-        except Exception:
-            logger.info(f"Creating device '{device_id}'...")
+        if device_id in self._known_ids:
+            logger.info("Device '%s' already exists.", device_id)
+            # Devices registered by earlier runs don't need a lookup for their keys
+            if device_id in self._known_credentials:
+                return device_id, self._known_credentials[device_id]
             try:
-                # Create device with default SAS key and enabled status
-                device = self.device_client.create_device_with_sas(
+                device = await self._call_registry(
+                    self.device_client.get_device, device_id)
+            except Exception as e:
+                logger.error(
+                    "Error retrieving credentials for device '%s': %s", device_id, e)
+                return device_id, {}
+        else:
+            logger.info("Creating device '%s'...", device_id)
+            try:
+                # Create device with default SAS key and enabled status; the
+                # returned device already carries the generated keys
+                device = await self._call_registry(
+                    self.device_client.create_device_with_sas,
                     device_id=device_id,
                     primary_key=None,
                     secondary_key=None,
                     status="enabled"
                 )
                 logger.info(
-                    f"Device '{device_id}' created successfully.")
+                    "Device '%s' created successfully.", device_id)
             except Exception as e:
-                logger.error(
-                    f"Error creating device '{device_id}': {e}")
-                return {}
-
-        # Get the device's credentials (primary key)
+                if getattr(getattr(e, "response", None), "status_code", None) != 409:
+                    logger.error(
+                        "Error creating device '%s': %s", device_id, e)
+                    return device_id, {}
+                # The device exists but wasn't preloaded (e.g. created since the
+                # registry query, or the query wasn't run), so fetch its keys instead
+                logger.info("Device '%s' already exists.", device_id)
+                try:
+                    device = await self._call_registry(
+                        self.device_client.get_device, device_id)
+                except Exception as e:
+                    logger.error(
+                        "Error retrieving credentials for device '%s': %s", device_id, e)
+                    return device_id, {}
+            self._known_ids.add(device_id)
+
+        # Devices using x509 or CA authentication have no symmetric key
         try:
-            device_info = self.device_client.get_device(device_id)
-            primary_key = device_info.authentication.symmetric_key.primary_key
+            primary_key = device.authentication.symmetric_key.primary_key
+        except AttributeError as e:
+            logger.error(
+                "Error retrieving credentials for device '%s': %s", device_id, e)
+            return device_id, {}
+        if not primary_key:
+            logger.error(
+                "Error retrieving credentials for device '%s': no SAS primary key", device_id)
+            return device_id, {}
+
+        return device_id, self.device_credentials(device_id, primary_key)
+
+    def device_credentials(self, device_id: str, primary_key: str) -> dict:
+        """
+        Builds the credentials dictionary of a device from its primary key.
+
+        :param device_id: The ID of the device.
+        :param primary_key: The device's primary SAS key.
+        :return: A dictionary with the device's hostname, ID and shared access key.
+        """
+        return {
+            "hostname": self.hostname,
+            "device_id": device_id,
+            "shared_access_key": primary_key
+        }
+
+    @staticmethod
+    def generate_sas_key() -> str:
+        """Generates a random base64-encoded 256-bit SAS key"""
+        return base64.b64encode(os.urandom(32)).decode()
 
-            # Return the device credentials as a dictionary
-            return {
-                "hostname": self.hostname,
-                "device_id": device_id,
-                "shared_access_key": primary_key
-            }
+    async def create_device_batch(self,
+                                  device_ids: list[str]) -> list[tuple[str, dict]]:
+        """
+        Creates up to BULK_BATCH_SIZE devices in the IoT Hub with a single bulk registry
+        request and returns their credentials. Devices which already exist are not
+        re-created; their credentials are fetched instead, including devices the bulk
+        request reports as already existing.
 
+        :param device_ids: List of device IDs to be created.
+        :return: A list of (device ID, credentials dictionary) pairs.
+        """
+        existing_ids = [d for d in device_ids if d in self._known_ids]
+        new_ids = [d for d in device_ids if d not in self._known_ids]
+
+        credentials_list = list(await asyncio.gather(
+            *[self.create_device(device_id) for device_id in existing_ids]))
+        if not new_ids:
+            return credentials_list
+
+        # The bulk API doesn't return generated keys, so the keys are generated
+        # here and no follow-up lookup is needed to fetch them
+        primary_keys = {device_id: self.generate_sas_key() for device_id in new_ids}
+        devices = [
+            ExportImportDevice(
+                id=device_id,
+                import_mode="create",
+                status="enabled",
+                authentication=AuthenticationMechanism(
+                    type="sas",
+                    symmetric_key=SymmetricKey(
+                        primary_key=primary_keys[device_id],
+                        secondary_key=self.generate_sas_key()
+                    )
+                )
+            )
+            for device_id in new_ids
+        ]
+        logger.info("Creating %s devices in bulk...", len(devices))
+        try:
+            result = await self._call_registry(
+                self.device_client.bulk_create_or_update_devices, devices)
         except Exception as e:
+            logger.error("Error creating devices %s: %s", new_ids, e)
+            return credentials_list
+
+        failed_ids = set()
+        # Devices missed by the preload query (it failed, or they were created since)
+        # are rejected by the "create" import mode; their keys are looked up instead
+        conflicting_ids = []
+        for error in result.errors or []:
+            failed_ids.add(error.device_id)
+            if error.error_code == "DeviceAlreadyExists":
+                self._known_ids.add(error.device_id)
+                conflicting_ids.append(error.device_id)
+                continue
             logger.error(
-                f"Error retrieving credentials for device '{device_id}': {e}")
-            return {}
+                "Error creating device '%s': %s", error.device_id, error.error_status)
+
+        for device_id in new_ids:
+            if device_id in failed_ids:
+                continue
+            self._known_ids.add(device_id)
+            logger.info("Device '%s' created successfully.", device_id)
+            credentials_list.append((device_id, self.device_credentials(
+                device_id, primary_keys[device_id])))
+
+        credentials_list.extend(await asyncio.gather(
+            *[self.create_device(device_id) for device_id in conflicting_ids]))
+        return credentials_list
 
     async def create_devices_from_list(self, device_ids: list[str]) -> dict:
         """
@@ -131,36 +578,71 @@ class DeviceHandler:
         """
         all_credentials = {}
 
-        tasks = []
-        for device_id in device_ids:
-            tasks.append(self.create_device(device_id))
+        await self._load_known_devices()
+        await self._preload_existing_devices()
+        await self.create_device_credentials_file()
 
-        credentials_list = await asyncio.gather(*tasks)
+        tasks = []
+        for i in range(0, len(device_ids), self.BULK_BATCH_SIZE):
+            tasks.append(self.create_device_batch(
+                device_ids[i:i + self.BULK_BATCH_SIZE]))
 
-        # Update credentials dictionary with device_id as key
-        for i, credentials in enumerate(credentials_list):
-            if credentials:
-                all_credentials[device_ids[i]] = credentials
+        # Store each batch's credentials as soon as it finishes, while the
+        # remaining batches are still waiting on the network
+        try:
+            for batch in asyncio.as_completed(tasks):
+                batch_credentials = {
+                    device_id: credentials
+                    for device_id, credentials in await batch if credentials}
+                all_credentials.update(batch_credentials)
+                for credentials in batch_credentials.values():
+                    self.write_device_credentials(credentials)
+                    self.remember_device_credentials(credentials)
+        finally:
+            await self.close_device_credentials_file()
+            await self._close_known_devices_file()
 
-        await self.create_device_credentials_file(all_credentials)
         return all_credentials
 
-    async def create_device_credentials_file(self, credentials: dict) -> None:
+    async def create_device_credentials_file(self) -> None:
+        """
+        Creates an NDJSON file to store device credentials (hostname and shared access key).
+        Credentials are appended to it one line per device as they become available.
         """
-        Creates a JSON file to store device credentials (hostname and shared access key).
+        try:
+            self._credentials_file = open(
+                self.CREDENTIALS_FILE_PATH, "wb", buffering=1 << 16)
+        except Exception as e:
+            logger.error("Failed to create credentials file: %s", e)
+
+    def write_device_credentials(self, credentials: dict) -> None:
+        """
+        Appends a single device's credentials to the credentials file.
 
-        :param credentials: A dictionary containing device credentials.
+        :param credentials: A dictionary containing the device's credentials.
         """
+        if not credentials or self._credentials_file is None:
+            return
         try:
-            file_path = "iothub_device_credential.json"
-            with open(file_path, "w") as f:
-                json.dump(credentials, f, indent=4)
+            self._credentials_file.write(encode_json_line(credentials))
+        except Exception as e:
+            logger.error(
+                "Failed to store credentials for device '%s': %s", credentials['device_id'], e)
 
+    async def close_device_credentials_file(self) -> None:
+        """
+        Flushes and closes the credentials file.
+        """
+        if self._credentials_file is None:
+            return
+        try:
+            self._credentials_file.close()
             logger.info(
-                f"Device credentials stored in {file_path}")
-
+                "Device credentials stored in %s", self.CREDENTIALS_FILE_PATH)
         except Exception as e:
-            logger.error(f"Failed to create credentials file: {e}")
+            logger.error("Failed to close credentials file: %s", e)
+        finally:
+            self._credentials_file = None
 
     async def connect_device(self, device_credential: dict) -> None:
         """
@@ -168,21 +650,18 @@ class DeviceHandler:
 
         :param device_credential: A dictionary containing the device's credentials.
         """
-        connection_string = (
-            f"HostName={device_credential['hostname']};"
-            f"DeviceId={device_credential['device_id']};"
-            f"SharedAccessKey={device_credential['shared_access_key']}"
-        )
+        connection_string = self._device_connection_template % (
+            device_credential['device_id'], device_credential['shared_access_key'])
         try:
             device_client = IoTHubDeviceClient.create_from_connection_string(
                 connection_string)
             await device_client.connect()
             logger.info(
-                f"Device {device_credential['device_id']} connected successfully.")
+                "Device %s connected successfully.", device_credential['device_id'])
             await device_client.disconnect()
         except Exception as e:
             logger.error(
-                f"Failed to connect device {device_credential['device_id']}: {e}")
+                "Failed to connect device %s: %s", device_credential['device_id'], e)
 
     async def connect_all_devices(self, all_credentials: dict) -> None:
         """
@@ -190,9 +669,17 @@ class DeviceHandler:
 
         :param all_credentials: Dictionary containing credentials of all devices.
         """
+        # Each connection is a full TLS + MQTT handshake, so only a bounded
+        # number of devices connect at the same time
+        semaphore = asyncio.Semaphore(self.max_concurrent_connections)
+
+        async def connect_device_gated(credentials: dict) -> None:
+            async with semaphore:
+                await self.connect_device(credentials)
+
         tasks = []
         for device_id, credentials in all_credentials.items():
-            tasks.append(self.connect_device(credentials))
+            tasks.append(connect_device_gated(credentials))
         await asyncio.gather(*tasks)
 
 
@@ -211,7 +698,7 @@ async def main():
 
         # List of device IDs to create
         mac_ids = generate_mac_handler.generate_mac_addresses()
-        logger.info(f"mac_ids: {mac_ids}")
+        logger.info("mac_ids: %s", mac_ids)
 
         # Create devices from list and retrieve credentials
         all_credentials = await device_handler.create_devices_from_list(
@@ -228,9 +715,13 @@ async def main():
                 "Device creation completed. Devices are not connected.")
 
     except Exception as e:
-        logger.info(f"Exception occurred: {e}")
+        logger.info("Exception occurred: %s", e)
         logger.error(
-            f"Twin connection failed with IoTHub: {e}")
+            "Twin connection failed with IoTHub: %s", e)
+    finally:
+        await device_handler.disconnect_hub()
+        log_listener.stop()
+        memory_handler.flush()
 
 
 if __name__ == "__main__":